@@ -1,10 +1,20 @@
-from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi import FastAPI, HTTPException, Request, Response, UploadFile, File
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel, Field, validator
+from fastapi.encoders import jsonable_encoder
+from pydantic import BaseModel, Field, validator, ValidationError
 from typing import Optional, List
 import pyodbc
 import os
+import io
+import csv
+import json
+import time
+import asyncio
+import queue
+import threading
+from collections import OrderedDict
+from decimal import Decimal
 from datetime import datetime, date
 from dotenv import load_dotenv
 
@@ -28,6 +38,85 @@ conn_str = (
     f"TrustServerCertificate=yes;"
 )
 
+# Réplica de lectura (secundario legible de Always On). Si no se define
+# DB_READ_SERVER todas las lecturas se hacen contra el primario.
+read_conn_str = None
+if os.getenv('DB_READ_SERVER'):
+    read_conn_str = (
+        f"DRIVER={{ODBC Driver 18 for SQL Server}};"
+        f"SERVER={os.getenv('DB_READ_SERVER')},{os.getenv('DB_READ_PORT', os.getenv('DB_PORT'))};"
+        f"DATABASE={os.getenv('DB_NAME')};"
+        f"UID={os.getenv('DB_READ_USER', os.getenv('DB_USER'))};"
+        f"PWD={os.getenv('DB_READ_PASSWORD', os.getenv('DB_PASSWORD'))};"
+        f"TrustServerCertificate=yes;"
+        f"ApplicationIntent=ReadOnly;"
+    )
+
+# Segundos durante los que un cliente lee del primario tras su propia escritura
+READ_YOUR_WRITES_SEGUNDOS = int(os.getenv('DB_READ_YOUR_WRITES_SECONDS', '5'))
+# Segundos que se deja de intentar la réplica después de un fallo de conexión
+REPLICA_REINTENTO_SEGUNDOS = int(os.getenv('DB_READ_RETRY_SECONDS', '30'))
+REPLICA_TIMEOUT_CONEXION = int(os.getenv('DB_READ_CONNECT_TIMEOUT', '3'))
+COOKIE_ULTIMA_ESCRITURA = "ultima_escritura"
+HEADER_LEER_PRIMARIO = "X-Leer-Primario"
+
+_replica_caida_hasta = 0.0
+
+# Pool de conexiones (por proceso). La aplicación gestiona su propio pool,
+# así que se desactiva el pooling del administrador ODBC.
+pyodbc.pooling = False
+POOL_TAMANO = int(os.getenv('DB_POOL_SIZE', '10'))
+POOL_PRECALENTAR = int(os.getenv('DB_POOL_WARM', '2'))
+POOL_ESPERA_SEGUNDOS = float(os.getenv('DB_POOL_TIMEOUT', '5'))
+# Una conexión inactiva más de este tiempo se comprueba antes de entregarla
+POOL_VERIFICAR_INACTIVA_SEGUNDOS = float(os.getenv('DB_POOL_VALIDATE_IDLE_SECONDS', '30'))
+
+# Caché en proceso de productos por id. Con varios workers cada proceso
+# tiene su propia caché y comprueba VersionCatalogo cada CACHE_COHERENCE_MS:
+# es el tiempo máximo que puede servir un producto modificado en otro worker
+CACHE_PRODUCTOS_MAX = int(os.getenv('CACHE_PRODUCTOS_MAX', '1000'))
+CACHE_COHERENCIA_SEGUNDOS = int(os.getenv('CACHE_COHERENCE_MS', '250')) / 1000
+
+# Archivo de productos dados de baja hace más de ARCHIVE_AFTER_DAYS días
+ARCHIVO_DIAS = int(os.getenv('ARCHIVE_AFTER_DAYS', '180'))
+ARCHIVO_TAMANO_LOTE = int(os.getenv('ARCHIVE_BATCH_SIZE', '500'))
+ARCHIVO_INTERVALO_SEGUNDOS = int(os.getenv('ARCHIVE_INTERVAL_SECONDS', '86400'))
+
+# Control de admisión por clase de ruta (por proceso): peticiones concurrentes,
+# tamaño de la cola de espera y tiempo máximo en cola antes de responder 503
+ADMISION_LECTURAS = int(os.getenv('ADMISSION_READ_CONCURRENCY', '6'))
+ADMISION_ESCRITURAS = int(os.getenv('ADMISSION_WRITE_CONCURRENCY', '4'))
+ADMISION_COLA = int(os.getenv('ADMISSION_QUEUE_SIZE', '16'))
+ADMISION_ESPERA_SEGUNDOS = int(os.getenv('ADMISSION_WAIT_MS', '500')) / 1000
+REINTENTAR_DESPUES_SEGUNDOS = int(os.getenv('RETRY_AFTER_SECONDS', '1'))
+
+# Conciliación completa de ResumenInventario (segundos entre ejecuciones)
+RESUMEN_RECONCILIACION_SEGUNDOS = int(os.getenv('SUMMARY_RECONCILE_SECONDS', '3600'))
+DIMENSIONES_RESUMEN = ('categoria', 'proveedor')
+
+# Columnas que se pueden pedir con ?fields= y máximo de ids por lote
+COLUMNAS_PRODUCTO = [
+    'id', 'codigo_barras', 'nombre', 'descripcion', 'categoria', 'proveedor',
+    'precio_compra', 'precio_venta', 'stock_actual', 'stock_minimo',
+    'fecha_vencimiento', 'fecha_creacion', 'activo', 'fecha_baja'
+]
+LOTE_MAX_IDS = int(os.getenv('BATCH_MAX_IDS', '500'))
+
+# Valores aceptados en ?activo= del listado y su literal SQL (None: sin filtro)
+VALORES_FILTRO_ACTIVO = {
+    'true': 1, '1': 1, 'si': 1,
+    'false': 0, '0': 0, 'no': 0,
+    'todos': None
+}
+
+# Importación masiva: filas por lote de MERGE
+IMPORTACION_TAMANO_LOTE = int(os.getenv('IMPORT_BATCH_SIZE', '500'))
+COLUMNAS_IMPORTACION = [
+    'codigo_barras', 'nombre', 'descripcion', 'categoria', 'proveedor',
+    'precio_compra', 'precio_venta', 'stock_actual', 'stock_minimo', 'fecha_vencimiento'
+]
+COLUMNAS_TEXTO_IMPORTACION = {'codigo_barras', 'nombre', 'descripcion', 'categoria', 'proveedor'}
+
 # Modelos Pydantic
 class ProductoBase(BaseModel):
     codigo_barras: str = Field(..., max_length=50)
@@ -67,18 +156,642 @@ class Producto(ProductoBase):
     id: int
     fecha_creacion: datetime
     activo: bool
+    fecha_baja: Optional[datetime] = None
 
     class Config:
         from_attributes = True
 
+class ValoracionGrupo(BaseModel):
+    grupo: Optional[str]
+    productos: int
+    unidades: int
+    valor_compra: float
+    valor_venta: float
+    margen: float
+    margen_porcentaje: Optional[float]
+
+# Pool de conexiones
+class PoolAgotado(Exception):
+    """No hay conexiones libres en el pool dentro del tiempo de espera"""
+
+class ConexionAgrupada:
+    """Envoltorio de una conexión del pool: close() la devuelve en lugar de cerrarla"""
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, nombre):
+        return getattr(self._conn, nombre)
+
+    def close(self):
+        if self._conn is not None:
+            self._pool.devolver(self._conn)
+            self._conn = None
+
+    def descartar(self):
+        """Cierra la conexión rota y la saca del pool"""
+        if self._conn is not None:
+            self._pool.descartar(self._conn)
+            self._conn = None
+
+class PoolConexiones:
+    """Pool acotado de conexiones pyodbc reutilizables"""
+
+    def __init__(self, cadena: str, tamano: int, timeout_conexion: int = 0):
+        self.cadena = cadena
+        self.tamano = tamano
+        self.timeout_conexion = timeout_conexion
+        self._libres = queue.LifoQueue()
+        self._abiertas = 0
+        self._lock = threading.Lock()
+
+    def _abrir(self):
+        try:
+            return pyodbc.connect(self.cadena, timeout=self.timeout_conexion)
+        except Exception:
+            with self._lock:
+                self._abiertas -= 1
+            raise
+
+    def _reservar(self) -> bool:
+        with self._lock:
+            if self._abiertas < self.tamano:
+                self._abiertas += 1
+                return True
+            return False
+
+    def _responde(self, conn) -> bool:
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+            cursor.close()
+            return True
+        except Exception:
+            return False
+
+    def _tomar_libre(self, espera: Optional[float] = None):
+        """Saca una conexión libre; las inactivas demasiado tiempo se comprueban antes"""
+        while True:
+            if espera is None:
+                conn, devuelta = self._libres.get_nowait()
+            else:
+                conn, devuelta = self._libres.get(timeout=espera)
+            if time.monotonic() - devuelta < POOL_VERIFICAR_INACTIVA_SEGUNDOS or self._responde(conn):
+                return conn
+            # Conexión rota (reinicio o failover del servidor): se descarta
+            self.descartar(conn)
+            if self._reservar():
+                return self._abrir()
+
+    def obtener(self) -> ConexionAgrupada:
+        try:
+            conn = self._tomar_libre()
+        except queue.Empty:
+            if self._reservar():
+                conn = self._abrir()
+            else:
+                try:
+                    conn = self._tomar_libre(POOL_ESPERA_SEGUNDOS)
+                except queue.Empty:
+                    raise PoolAgotado("No hay conexiones disponibles en el pool")
+        return ConexionAgrupada(self, conn)
+
+    def devolver(self, conn):
+        try:
+            # Deshacer cualquier transacción pendiente antes de reutilizarla
+            conn.rollback()
+            self._libres.put((conn, time.monotonic()))
+        except Exception:
+            self.descartar(conn)
+
+    def descartar(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._lock:
+            self._abiertas -= 1
+
+    def precalentar(self, cantidad: int):
+        """Abre conexiones por adelantado hasta tener `cantidad` en el pool"""
+        while self._abiertas < min(cantidad, self.tamano) and self._reservar():
+            self._libres.put((self._abrir(), time.monotonic()))
+
+    def verificar(self) -> bool:
+        """Comprueba una conexión ya abierta del pool sin abrir una nueva"""
+        try:
+            conn, _ = self._libres.get_nowait()
+        except queue.Empty:
+            # Todas ocupadas: el pool está en uso; vacío: todavía no está listo
+            return self._abiertas > 0
+        if not self._responde(conn):
+            self.descartar(conn)
+            return False
+        self.devolver(conn)
+        return True
+
+    def cerrar(self):
+        while True:
+            try:
+                conn, _ = self._libres.get_nowait()
+            except queue.Empty:
+                break
+            self.descartar(conn)
+
+pool_escritura = PoolConexiones(conn_str, POOL_TAMANO)
+pool_lectura = PoolConexiones(read_conn_str, POOL_TAMANO, REPLICA_TIMEOUT_CONEXION) if read_conn_str else None
+
 # Funciones de base de datos
 def get_db_connection():
     try:
-        conn = pyodbc.connect(conn_str)
-        return conn
+        return pool_escritura.obtener()
+    except PoolAgotado as e:
+        raise HTTPException(
+            status_code=503,
+            detail=str(e),
+            headers={"Retry-After": str(REINTENTAR_DESPUES_SEGUNDOS)}
+        )
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al conectar a la base de datos: {str(e)}")
 
+def requiere_primario(request: Optional[Request]) -> bool:
+    """Indica si la petición debe leer del primario (read-your-writes)"""
+    if request is None:
+        return False
+    if request.headers.get(HEADER_LEER_PRIMARIO, "").lower() in ("1", "true", "si"):
+        return True
+    ultima_escritura = request.cookies.get(COOKIE_ULTIMA_ESCRITURA)
+    try:
+        return time.time() - float(ultima_escritura) < READ_YOUR_WRITES_SEGUNDOS
+    except (TypeError, ValueError):
+        return False
+
+def get_db_read_connection(request: Optional[Request] = None):
+    """Conexión para lecturas: usa la réplica salvo read-your-writes o réplica caída"""
+    global _replica_caida_hasta
+    if pool_lectura is None or requiere_primario(request) or time.monotonic() < _replica_caida_hasta:
+        return get_db_connection()
+    try:
+        return pool_lectura.obtener()
+    except PoolAgotado:
+        return get_db_connection()
+    except Exception:
+        # Réplica no disponible: se usa el primario hasta el próximo reintento
+        _replica_caida_hasta = time.monotonic() + REPLICA_REINTENTO_SEGUNDOS
+        return get_db_connection()
+
+def es_conexion_primaria(conn) -> bool:
+    """Indica si la conexión es del primario (las de la réplica pueden ir con retraso)"""
+    return isinstance(conn, ConexionAgrupada) and conn._pool is pool_escritura
+
+def es_error_de_conexion(e: Exception) -> bool:
+    """Errores de conexión o comunicación con el servidor (SQLSTATE 08xxx)"""
+    if isinstance(e, pyodbc.OperationalError):
+        return True
+    return isinstance(e, pyodbc.Error) and bool(e.args) and str(e.args[0]).startswith("08")
+
+def _consultar(conn, query: str, params):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(query, params)
+        return [column[0] for column in cursor.description], cursor.fetchall()
+    finally:
+        cursor.close()
+
+def ejecutar_lectura(request: Optional[Request], query: str, params=()):
+    """Ejecuta una consulta de lectura y devuelve (columnas, filas, desde_primario).
+
+    Si una conexión de la réplica falla por conexión o comunicación, la réplica
+    se marca caída y la consulta se repite una vez en el primario.
+    """
+    global _replica_caida_hasta
+    conn = get_db_read_connection(request)
+    try:
+        columns, rows = _consultar(conn, query, params)
+        return columns, rows, es_conexion_primaria(conn)
+    except Exception as e:
+        if es_conexion_primaria(conn) or not es_error_de_conexion(e):
+            raise
+        _replica_caida_hasta = time.monotonic() + REPLICA_REINTENTO_SEGUNDOS
+        conn.descartar()
+        # El resto de conexiones libres de la réplica probablemente también están rotas
+        pool_lectura.cerrar()
+    finally:
+        conn.close()
+
+    conn = get_db_connection()
+    try:
+        columns, rows = _consultar(conn, query, params)
+        return columns, rows, True
+    finally:
+        conn.close()
+
+def marcar_escritura(response: Response):
+    """Marca al cliente para que sus próximas lecturas vayan al primario"""
+    response.set_cookie(
+        COOKIE_ULTIMA_ESCRITURA,
+        str(time.time()),
+        max_age=READ_YOUR_WRITES_SEGUNDOS,
+        httponly=True
+    )
+
+def fila_a_producto(columns, row) -> dict:
+    """Convierte una fila de Productos en dict con las fechas en formato ISO"""
+    producto = dict(zip(columns, row))
+    if 'fecha_vencimiento' in producto and producto['fecha_vencimiento']:
+        producto['fecha_vencimiento'] = producto['fecha_vencimiento'].isoformat()
+    if 'fecha_creacion' in producto and producto['fecha_creacion']:
+        producto['fecha_creacion'] = producto['fecha_creacion'].isoformat()
+    return producto
+
+def parsear_campos(fields: Optional[str]) -> Optional[List[str]]:
+    """Valida ?fields=a,b,c contra COLUMNAS_PRODUCTO; el id se incluye siempre"""
+    if not fields:
+        return None
+    campos = ['id']
+    for campo in fields.split(','):
+        campo = campo.strip()
+        if not campo or campo in campos:
+            continue
+        if campo not in COLUMNAS_PRODUCTO:
+            raise HTTPException(status_code=400, detail=f"Campo no válido: {campo}")
+        campos.append(campo)
+    return campos
+
+def columnas_sql(campos: Optional[List[str]]) -> str:
+    return ", ".join(campos) if campos else "*"
+
+def proyectar(producto: dict, campos: Optional[List[str]]) -> dict:
+    if not campos:
+        return producto
+    return {campo: producto.get(campo) for campo in campos}
+
+# Caché de productos (LRU en proceso)
+_cache_productos = OrderedDict()
+_cache_lock = threading.Lock()
+
+_version_catalogo = {"version": None, "comprobada": 0.0}
+
+def incrementar_version_catalogo(cursor):
+    """Anuncia un cambio a los demás workers; llamar dentro de la transacción de escritura"""
+    cursor.execute("UPDATE VersionCatalogo SET version = version + 1 WHERE id = 1")
+
+def sincronizar_cache():
+    """Vacía la caché si otro proceso modificó el catálogo desde la última comprobación"""
+    ahora = time.monotonic()
+    if ahora - _version_catalogo["comprobada"] < CACHE_COHERENCIA_SEGUNDOS:
+        return
+    conn = None
+    cursor = None
+    try:
+        # Siempre contra el primario: la réplica puede ir con retraso
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT version FROM VersionCatalogo WHERE id = 1")
+        version = cursor.fetchone()[0]
+    except Exception:
+        # Sin poder comprobar la versión no se sirve nada desde la caché
+        version = None
+    finally:
+        if cursor:
+            cursor.close()
+        if conn:
+            conn.close()
+    with _cache_lock:
+        if version is None or version != _version_catalogo["version"]:
+            _cache_productos.clear()
+            _version_catalogo["version"] = version
+    if version is not None:
+        _version_catalogo["comprobada"] = ahora
+
+def version_cache() -> Optional[int]:
+    """Versión vigente de la caché; tomarla antes de leer las filas que se van a guardar"""
+    sincronizar_cache()
+    return _version_catalogo["version"]
+
+def cache_obtener(producto_id: int) -> Optional[dict]:
+    sincronizar_cache()
+    with _cache_lock:
+        producto = _cache_productos.get(producto_id)
+        if producto is None:
+            return None
+        _cache_productos.move_to_end(producto_id)
+        return dict(producto)
+
+def cache_guardar(producto: dict, version: Optional[int]):
+    """Guarda el producto si la caché no se vació desde que se tomó `version`"""
+    with _cache_lock:
+        if version is None or version != _version_catalogo["version"]:
+            return
+        _cache_productos[producto['id']] = dict(producto)
+        _cache_productos.move_to_end(producto['id'])
+        while len(_cache_productos) > CACHE_PRODUCTOS_MAX:
+            _cache_productos.popitem(last=False)
+
+def cache_invalidar(producto_id: Optional[int] = None):
+    """Invalida un producto o, sin id, toda la caché"""
+    with _cache_lock:
+        if producto_id is None:
+            _cache_productos.clear()
+        else:
+            _cache_productos.pop(producto_id, None)
+
+# Resumen de valoración de inventario (agregados incrementales)
+def acumular_resumen(deltas: dict, fila: Optional[dict], signo: int):
+    """Suma (signo=1) o resta (signo=-1) la aportación de un producto activo a los grupos"""
+    if not fila or not fila.get('activo'):
+        return
+    stock = fila.get('stock_actual') or 0
+    valor_compra = stock * Decimal(str(fila['precio_compra']))
+    valor_venta = stock * Decimal(str(fila['precio_venta']))
+    for dimension in DIMENSIONES_RESUMEN:
+        delta = deltas.setdefault((dimension, fila.get(dimension) or ''), [0, 0, Decimal(0), Decimal(0)])
+        delta[0] += signo
+        delta[1] += signo * stock
+        delta[2] += signo * valor_compra
+        delta[3] += signo * valor_venta
+
+def aplicar_resumen(cursor, deltas: dict):
+    """Aplica los deltas a ResumenInventario dentro de la transacción de escritura"""
+    # Orden fijo por (dimension, valor): todas las escrituras bloquean los grupos
+    # en el mismo orden y no se interbloquean entre sí
+    for (dimension, valor), (productos, unidades, valor_compra, valor_venta) in sorted(deltas.items()):
+        if not productos and not unidades and not valor_compra and not valor_venta:
+            continue
+        cursor.execute("""
+        MERGE ResumenInventario WITH (HOLDLOCK) AS r
+        USING (SELECT ? AS dimension, ? AS valor) AS o
+            ON r.dimension = o.dimension AND r.valor = o.valor
+        WHEN MATCHED AND r.productos + ? = 0 THEN DELETE
+        WHEN MATCHED THEN UPDATE SET
+            productos = r.productos + ?,
+            unidades = r.unidades + ?,
+            valor_compra = r.valor_compra + ?,
+            valor_venta = r.valor_venta + ?
+        WHEN NOT MATCHED THEN INSERT (dimension, valor, productos, unidades, valor_compra, valor_venta)
+            VALUES (o.dimension, o.valor, ?, ?, ?, ?);
+        """, (
+            dimension, valor, productos,
+            productos, unidades, valor_compra, valor_venta,
+            productos, unidades, valor_compra, valor_venta
+        ))
+
+def reconciliar_resumen() -> bool:
+    """Recalcula ResumenInventario desde Productos; devuelve False si otro proceso ya lo hace"""
+    conn = None
+    cursor = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        # Ante un interbloqueo con una escritura, la víctima debe ser la conciliación
+        cursor.execute("SET DEADLOCK_PRIORITY LOW")
+        cursor.execute("""
+        DECLARE @resultado INT;
+        EXEC @resultado = sp_getapplock
+            @Resource = 'ResumenInventario', @LockMode = 'Exclusive',
+            @LockOwner = 'Transaction', @LockTimeout = 0;
+        SELECT @resultado;
+        """)
+        if cursor.fetchone()[0] < 0:
+            conn.rollback()
+            return False
+        cursor.execute("DELETE FROM ResumenInventario")
+        for dimension in DIMENSIONES_RESUMEN:
+            cursor.execute(f"""
+            INSERT INTO ResumenInventario (dimension, valor, productos, unidades, valor_compra, valor_venta)
+            SELECT ?, ISNULL({dimension}, ''), COUNT(*), SUM(CAST(stock_actual AS BIGINT)),
+                   SUM(stock_actual * precio_compra), SUM(stock_actual * precio_venta)
+            FROM Productos
+            WHERE activo = 1
+            GROUP BY ISNULL({dimension}, '')
+            """, (dimension,))
+        conn.commit()
+        return True
+    finally:
+        if cursor:
+            try:
+                cursor.execute("SET DEADLOCK_PRIORITY NORMAL")
+            except Exception:
+                pass
+            cursor.close()
+        if conn:
+            conn.close()
+
+def reconciliar_resumen_periodicamente():
+    while True:
+        time.sleep(RESUMEN_RECONCILIACION_SEGUNDOS)
+        try:
+            reconciliar_resumen()
+        except Exception:
+            # Se reintenta en el siguiente periodo
+            pass
+
+# Archivo de productos inactivos
+def archivar_inactivos() -> int:
+    """Mueve a ProductosArchivo, por lotes, los productos dados de baja hace tiempo"""
+    conn = None
+    cursor = None
+    total = 0
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        while True:
+            cursor.execute("""
+            DELETE TOP (?) FROM Productos
+            OUTPUT deleted.id, deleted.codigo_barras, deleted.nombre, deleted.descripcion,
+                   deleted.categoria, deleted.proveedor, deleted.precio_compra, deleted.precio_venta,
+                   deleted.stock_actual, deleted.stock_minimo, deleted.fecha_vencimiento,
+                   deleted.fecha_creacion, deleted.fecha_baja
+            INTO ProductosArchivo (
+                id, codigo_barras, nombre, descripcion,
+                categoria, proveedor, precio_compra, precio_venta,
+                stock_actual, stock_minimo, fecha_vencimiento,
+                fecha_creacion, fecha_baja
+            )
+            WHERE activo = 0 AND fecha_baja < DATEADD(day, -?, GETDATE())
+            """, (ARCHIVO_TAMANO_LOTE, ARCHIVO_DIAS))
+            movidos = cursor.rowcount
+            if movidos <= 0:
+                conn.rollback()
+                break
+            # Solo se archivan productos inactivos: el resumen de valoración no cambia
+            incrementar_version_catalogo(cursor)
+            conn.commit()
+            cache_invalidar()
+            total += movidos
+            if movidos < ARCHIVO_TAMANO_LOTE:
+                break
+        return total
+    finally:
+        if cursor:
+            cursor.close()
+        if conn:
+            conn.close()
+
+def archivar_periodicamente():
+    while True:
+        time.sleep(ARCHIVO_INTERVALO_SEGUNDOS)
+        try:
+            archivar_inactivos()
+        except Exception:
+            # Se reintenta en el siguiente periodo
+            pass
+
+# ==================== CONTROL DE ADMISIÓN ====================
+
+class ControlAdmision:
+    """Concurrencia acotada con una cola de espera corta para una clase de rutas"""
+
+    def __init__(self, concurrencia: int, cola: int, espera: float):
+        self._semaforo = asyncio.Semaphore(concurrencia)
+        self._cola_max = cola
+        self._en_cola = 0
+        self._espera = espera
+
+    async def entrar(self) -> bool:
+        if not self._semaforo.locked():
+            await self._semaforo.acquire()
+            return True
+        if self._en_cola >= self._cola_max:
+            return False
+        self._en_cola += 1
+        try:
+            await asyncio.wait_for(self._semaforo.acquire(), timeout=self._espera)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._en_cola -= 1
+
+    def salir(self):
+        self._semaforo.release()
+
+admision_lecturas = ControlAdmision(ADMISION_LECTURAS, ADMISION_COLA, ADMISION_ESPERA_SEGUNDOS)
+admision_escrituras = ControlAdmision(ADMISION_ESCRITURAS, ADMISION_COLA, ADMISION_ESPERA_SEGUNDOS)
+
+class AdmisionMiddleware:
+    """Aplica el control de admisión a /api/ y rechaza con 503 cuando la cola está llena"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith("/api/"):
+            await self.app(scope, receive, send)
+            return
+
+        control = admision_lecturas if scope["method"] in ("GET", "HEAD") else admision_escrituras
+        if not await control.entrar():
+            respuesta = JSONResponse(
+                status_code=503,
+                content={"detail": "Servicio saturado, intente de nuevo en unos segundos"},
+                headers={"Retry-After": str(REINTENTAR_DESPUES_SEGUNDOS)}
+            )
+            await respuesta(scope, receive, send)
+            return
+
+        # El permiso se libera al terminar de enviar la respuesta (incluido el streaming)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            control.salir()
+
+app.add_middleware(AdmisionMiddleware)
+
+# ==================== ARRANQUE Y SALUD ====================
+
+_estado_arranque = {"listo": False, "error": None, "precalentando": False}
+_arranque_lock = threading.Lock()
+
+def precalentar():
+    """Abre conexiones del pool y carga la caché antes de aceptar tráfico"""
+    pool_escritura.precalentar(POOL_PRECALENTAR)
+    if pool_lectura is not None:
+        try:
+            pool_lectura.precalentar(POOL_PRECALENTAR)
+        except Exception:
+            # Sin réplica se sigue leyendo del primario
+            pass
+
+    # La caché solo se llena desde el primario
+    version = version_cache()
+    conn = get_db_connection()
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        # Misma consulta que el listado principal: deja el plan y las páginas en memoria
+        cursor.execute("SELECT * FROM Productos WHERE 1=1 AND activo = 1 ORDER BY nombre")
+        columns = [column[0] for column in cursor.description]
+        productos = cursor.fetchmany(CACHE_PRODUCTOS_MAX)
+        for row in productos:
+            cache_guardar(fila_a_producto(columns, row), version)
+    finally:
+        if cursor:
+            cursor.close()
+        conn.close()
+
+def precalentar_en_segundo_plano():
+    """Reintenta el precalentamiento hasta que la base de datos responda"""
+    try:
+        while True:
+            try:
+                precalentar()
+                _estado_arranque["listo"] = True
+                _estado_arranque["error"] = None
+                return
+            except Exception as e:
+                _estado_arranque["error"] = str(getattr(e, "detail", e))
+                time.sleep(2)
+    finally:
+        _estado_arranque["precalentando"] = False
+
+def iniciar_precalentamiento():
+    """Lanza el precalentamiento en segundo plano si no hay uno en curso"""
+    with _arranque_lock:
+        if _estado_arranque["precalentando"]:
+            return
+        _estado_arranque["precalentando"] = True
+        _estado_arranque["listo"] = False
+    threading.Thread(target=precalentar_en_segundo_plano, daemon=True).start()
+
+@app.on_event("startup")
+async def al_iniciar():
+    # El proceso arranca en seguida; /readyz indica cuándo puede recibir tráfico
+    iniciar_precalentamiento()
+    threading.Thread(target=reconciliar_resumen_periodicamente, daemon=True).start()
+    threading.Thread(target=archivar_periodicamente, daemon=True).start()
+
+@app.on_event("shutdown")
+async def al_detener():
+    pool_escritura.cerrar()
+    if pool_lectura is not None:
+        pool_lectura.cerrar()
+
+@app.get("/healthz")
+async def healthz():
+    """Liveness: el proceso responde (no consulta la base de datos)"""
+    return {"estado": "ok"}
+
+@app.get("/readyz")
+def readyz():
+    """Readiness: precalentamiento terminado y una conexión del pool responde"""
+    if not _estado_arranque["listo"]:
+        return JSONResponse(
+            status_code=503,
+            content={"estado": "iniciando", "detalle": _estado_arranque["error"]}
+        )
+    if not pool_escritura.verificar():
+        # Tras un reinicio de la base de datos el pool se queda sin conexiones
+        # válidas: se vuelve a precalentar en segundo plano, /readyz no abre ninguna
+        iniciar_precalentamiento()
+        return JSONResponse(
+            status_code=503,
+            content={"estado": "sin conexión", "detalle": "El pool de la base de datos no responde"}
+        )
+    return {"estado": "listo"}
+
 # ==================== INTERFAZ WEB ====================
 
 @app.get("/", response_class=HTMLResponse)
@@ -314,7 +1027,8 @@ async def home():
             // Cargar lista de productos
             async function cargarProductos() {
                 try {
-                    const response = await fetch('/api/productos');
+                    // La tabla muestra también los inactivos para poder reactivarlos
+                    const response = await fetch('/api/productos?activo=todos');
                     if (!response.ok) throw new Error('Error al cargar productos');
                     
                     productos = await response.json();
@@ -559,44 +1273,62 @@ async def home():
 # ==================== API ENDPOINTS ====================
 
 @app.post("/api/productos/", response_model=Producto)
-async def crear_producto(producto: ProductoCreate):
-    """Crear un nuevo producto en el inventario"""
+def crear_producto(producto: ProductoCreate, response: Response):
+    """Crear un nuevo producto en el inventario (reactiva uno dado de baja con el mismo código)"""
     conn = None
     cursor = None
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
         
-        query = """
-        INSERT INTO Productos (
-            codigo_barras, nombre, descripcion, categoria, proveedor,
-            precio_compra, precio_venta, stock_actual, stock_minimo, fecha_vencimiento
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """
+        valores = (
+            producto.nombre,
+            producto.descripcion,
+            producto.categoria,
+            producto.proveedor,
+            producto.precio_compra,
+            producto.precio_venta,
+            producto.stock_actual,
+            producto.stock_minimo,
+            producto.fecha_vencimiento
+        )
         
+        # Un producto dado de baja conserva su código de barras hasta archivarse:
+        # crearlo de nuevo lo reactiva con los datos recibidos
         cursor.execute(
-            query,
-            (
-                producto.codigo_barras,
-                producto.nombre,
-                producto.descripcion,
-                producto.categoria,
-                producto.proveedor,
-                producto.precio_compra,
-                producto.precio_venta,
-                producto.stock_actual,
-                producto.stock_minimo,
-                producto.fecha_vencimiento
-            )
+            "SELECT id FROM Productos WITH (UPDLOCK, HOLDLOCK) WHERE codigo_barras = ? AND activo = 0",
+            (producto.codigo_barras,)
         )
+        inactivo = cursor.fetchone()
         
-        # Obtener el ID del producto recién insertado
-        cursor.execute("SELECT SCOPE_IDENTITY()")
-        producto_id = cursor.fetchone()[0]
-        
-        conn.commit()
+        if inactivo:
+            producto_id = inactivo[0]
+            cursor.execute(
+                """
+                UPDATE Productos SET
+                    nombre = ?, descripcion = ?, categoria = ?, proveedor = ?,
+                    precio_compra = ?, precio_venta = ?, stock_actual = ?, stock_minimo = ?,
+                    fecha_vencimiento = ?, activo = 1, fecha_baja = NULL
+                WHERE id = ?
+                """,
+                valores + (producto_id,)
+            )
+        else:
+            query = """
+            INSERT INTO Productos (
+                codigo_barras, nombre, descripcion, categoria, proveedor,
+                precio_compra, precio_venta, stock_actual, stock_minimo, fecha_vencimiento
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """
+            
+            cursor.execute(query, (producto.codigo_barras,) + valores)
+            
+            # Obtener el ID del producto recién insertado
+            cursor.execute("SELECT SCOPE_IDENTITY()")
+            producto_id = cursor.fetchone()[0]
         
-        # Obtener el producto completo para devolverlo
+        # Obtener el producto tal como quedó guardado (precios ya redondeados
+        # a DECIMAL(10,2)) para el resumen y la respuesta
         cursor.execute(
             "SELECT * FROM Productos WHERE id = ?",
             (producto_id,)
@@ -605,6 +1337,15 @@ async def crear_producto(producto: ProductoCreate):
         columns = [column[0] for column in cursor.description]
         producto_creado = dict(zip(columns, cursor.fetchone()))
         
+        # El producto anterior estaba inactivo: solo se suma la nueva aportación
+        deltas = {}
+        acumular_resumen(deltas, producto_creado, 1)
+        aplicar_resumen(cursor, deltas)
+        incrementar_version_catalogo(cursor)
+        conn.commit()
+        cache_invalidar(producto_id)
+        marcar_escritura(response)
+        
         return producto_creado
         
     except pyodbc.IntegrityError as e:
@@ -614,6 +1355,8 @@ async def crear_producto(producto: ProductoCreate):
                 detail="Ya existe un producto con este código de barras"
             )
         raise HTTPException(status_code=400, detail=str(e))
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     finally:
@@ -622,21 +1365,238 @@ async def crear_producto(producto: ProductoCreate):
         if conn:
             conn.close()
 
-@app.get("/api/productos/", response_model=List[Producto])
-async def listar_productos(activo: bool = None, categoria: str = None):
-    """Listar todos los productos del inventario"""
+def leer_filas_csv(archivo):
+    """Recorre un CSV fila a fila sin cargarlo completo en memoria"""
+    texto = io.TextIOWrapper(archivo, encoding="utf-8-sig", newline="")
+    try:
+        for numero, fila in enumerate(csv.DictReader(texto), start=2):
+            yield numero, fila
+    finally:
+        texto.detach()
+
+def leer_filas_excel(archivo):
+    """Recorre la primera hoja de un .xlsx en modo de solo lectura"""
+    from openpyxl import load_workbook
+
+    libro = load_workbook(archivo, read_only=True, data_only=True)
+    try:
+        filas = libro.active.iter_rows(values_only=True)
+        encabezado = [str(c).strip() if c is not None else "" for c in next(filas, ())]
+        for numero, valores in enumerate(filas, start=2):
+            fila = {}
+            for columna, valor in zip(encabezado, valores):
+                if isinstance(valor, datetime):
+                    valor = valor.date()
+                fila[columna] = valor
+            yield numero, fila
+    finally:
+        libro.close()
+
+def validar_fila_importacion(fila: dict) -> ProductoCreate:
+    """Valida una fila con las mismas reglas que ProductoBase"""
+    datos = {}
+    for columna in COLUMNAS_IMPORTACION:
+        valor = fila.get(columna)
+        if isinstance(valor, str):
+            valor = valor.strip()
+        elif columna in COLUMNAS_TEXTO_IMPORTACION and isinstance(valor, (int, float)):
+            # Excel guarda los códigos de barras como números
+            valor = str(int(valor)) if float(valor).is_integer() else str(valor)
+        if valor not in (None, ""):
+            datos[columna] = valor
+    return ProductoCreate(**datos)
+
+def upsert_lote(cursor, lote: List[ProductoCreate]):
+    """Inserta, actualiza o reactiva un lote por codigo_barras con un único MERGE"""
+    cursor.execute("DELETE FROM #ImportacionProductos")
+    cursor.fast_executemany = True
+    cursor.executemany(
+        f"INSERT INTO #ImportacionProductos ({', '.join(COLUMNAS_IMPORTACION)}) "
+        f"VALUES ({', '.join('?' for _ in COLUMNAS_IMPORTACION)})",
+        [tuple(getattr(p, c) for c in COLUMNAS_IMPORTACION) for p in lote]
+    )
+    cursor.execute("""
+    MERGE Productos WITH (HOLDLOCK) AS destino
+    USING #ImportacionProductos AS origen
+        ON destino.codigo_barras = origen.codigo_barras
+    WHEN MATCHED THEN UPDATE SET
+        nombre = origen.nombre,
+        descripcion = origen.descripcion,
+        categoria = origen.categoria,
+        proveedor = origen.proveedor,
+        precio_compra = origen.precio_compra,
+        precio_venta = origen.precio_venta,
+        stock_actual = origen.stock_actual,
+        stock_minimo = origen.stock_minimo,
+        fecha_vencimiento = origen.fecha_vencimiento,
+        activo = 1,
+        fecha_baja = NULL
+    WHEN NOT MATCHED THEN INSERT (
+        codigo_barras, nombre, descripcion, categoria, proveedor,
+        precio_compra, precio_venta, stock_actual, stock_minimo, fecha_vencimiento
+    ) VALUES (
+        origen.codigo_barras, origen.nombre, origen.descripcion, origen.categoria, origen.proveedor,
+        origen.precio_compra, origen.precio_venta, origen.stock_actual, origen.stock_minimo, origen.fecha_vencimiento
+    )
+    OUTPUT $action,
+        deleted.activo, deleted.categoria, deleted.proveedor,
+        deleted.stock_actual, deleted.precio_compra, deleted.precio_venta,
+        inserted.activo, inserted.categoria, inserted.proveedor,
+        inserted.stock_actual, inserted.precio_compra, inserted.precio_venta;
+    """)
+    columnas = ('activo', 'categoria', 'proveedor', 'stock_actual', 'precio_compra', 'precio_venta')
+    insertadas = actualizadas = reactivadas = 0
+    deltas = {}
+    for fila in cursor.fetchall():
+        if fila[0] == "INSERT":
+            insertadas += 1
+        elif fila[1]:
+            actualizadas += 1
+        else:
+            # Producto dado de baja (aún sin archivar): la importación lo reactiva
+            reactivadas += 1
+        if fila[0] == "UPDATE":
+            acumular_resumen(deltas, dict(zip(columnas, fila[1:7])), -1)
+        acumular_resumen(deltas, dict(zip(columnas, fila[7:13])), 1)
+    aplicar_resumen(cursor, deltas)
+    return insertadas, actualizadas, reactivadas
+
+def importar_productos_stream(archivo, filas):
+    """Procesa las filas por lotes y emite el progreso como líneas JSON"""
     conn = None
     cursor = None
+    resumen = {"procesadas": 0, "insertadas": 0, "actualizadas": 0, "reactivadas": 0, "duplicadas": 0, "errores": 0}
+
+    def linea(tipo, **datos):
+        return json.dumps({"tipo": tipo, **datos}, default=str) + "\n"
+
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
-        
-        query = "SELECT * FROM Productos WHERE 1=1"
+        cursor.execute("DROP TABLE IF EXISTS #ImportacionProductos")
+        cursor.execute("""
+        CREATE TABLE #ImportacionProductos (
+            codigo_barras NVARCHAR(50) NOT NULL PRIMARY KEY,
+            nombre NVARCHAR(100) NOT NULL,
+            descripcion NVARCHAR(255),
+            categoria NVARCHAR(50),
+            proveedor NVARCHAR(100),
+            precio_compra DECIMAL(10, 2) NOT NULL,
+            precio_venta DECIMAL(10, 2) NOT NULL,
+            stock_actual INT NOT NULL,
+            stock_minimo INT,
+            fecha_vencimiento DATE
+        )
+        """)
+        # Confirmar ya la tabla temporal: un rollback de un lote no debe deshacerla
+        conn.commit()
+
+        def confirmar(productos):
+            insertadas, actualizadas, reactivadas = upsert_lote(cursor, productos)
+            incrementar_version_catalogo(cursor)
+            conn.commit()
+            cache_invalidar()
+            resumen["insertadas"] += insertadas
+            resumen["actualizadas"] += actualizadas
+            resumen["reactivadas"] += reactivadas
+
+        def aplicar(lote):
+            productos = list(lote.values())
+            try:
+                confirmar([p for _, p in productos])
+                return []
+            except Exception:
+                conn.rollback()
+            # El lote falló: se reintenta fila a fila para rechazar solo las erróneas
+            errores = []
+            for numero, p in productos:
+                try:
+                    confirmar([p])
+                except Exception as e:
+                    conn.rollback()
+                    resumen["errores"] += 1
+                    errores.append(linea("error", fila=numero, codigo_barras=p.codigo_barras, detalle=str(e)))
+            return errores
+
+        lote = {}
+        for numero, fila in filas:
+            resumen["procesadas"] += 1
+            try:
+                producto = validar_fila_importacion(fila)
+            except ValidationError as e:
+                resumen["errores"] += 1
+                errores = "; ".join(
+                    f"{'.'.join(str(c) for c in err['loc'])}: {err['msg']}" for err in e.errors()
+                )
+                yield linea("error", fila=numero, codigo_barras=fila.get("codigo_barras"), detalle=errores)
+                continue
+
+            # Un código repetido en el lote se queda con la última fila
+            anterior = lote.get(producto.codigo_barras)
+            if anterior is not None:
+                resumen["duplicadas"] += 1
+                yield linea(
+                    "aviso", fila=anterior[0], codigo_barras=producto.codigo_barras,
+                    detalle=f"Reemplazada por la fila {numero} con el mismo código de barras"
+                )
+            lote[producto.codigo_barras] = (numero, producto)
+            if len(lote) >= IMPORTACION_TAMANO_LOTE:
+                yield from aplicar(lote)
+                lote = {}
+                yield linea("progreso", **resumen)
+
+        if lote:
+            yield from aplicar(lote)
+
+        yield linea("resumen", **resumen)
+
+    except Exception as e:
+        yield linea("error", fila=None, codigo_barras=None, detalle=str(e))
+        yield linea("resumen", **resumen)
+    finally:
+        if cursor:
+            try:
+                # La conexión vuelve al pool: no dejar la tabla temporal en la sesión
+                cursor.execute("DROP TABLE IF EXISTS #ImportacionProductos")
+                conn.commit()
+            except Exception:
+                pass
+            cursor.close()
+        if conn:
+            conn.close()
+        archivo.close()
+
+@app.post("/api/productos/importar")
+async def importar_productos(archivo: UploadFile = File(...)):
+    """Importar o actualizar productos desde un CSV o Excel (.xlsx) por codigo_barras"""
+    nombre = (archivo.filename or "").lower()
+    if not (nombre.endswith(".csv") or nombre.endswith(".xlsx") or not nombre):
+        raise HTTPException(status_code=400, detail="Formato no soportado, use .csv o .xlsx")
+
+    # El formulario se cierra al terminar el endpoint, antes que el streaming:
+    # el generador se queda con el archivo y lo cierra al acabar
+    fuente = archivo.file
+    archivo.file = io.BytesIO()
+    filas = leer_filas_excel(fuente) if nombre.endswith(".xlsx") else leer_filas_csv(fuente)
+
+    respuesta = StreamingResponse(importar_productos_stream(fuente, filas), media_type="application/x-ndjson")
+    marcar_escritura(respuesta)
+    return respuesta
+
+@app.get("/api/productos/", response_model=List[Producto])
+def listar_productos(request: Request, activo: str = "true", categoria: str = None, fields: str = None):
+    """Listar los productos del inventario (por defecto solo los activos; ?activo=todos para todos)"""
+    campos = parsear_campos(fields)
+    activo = activo.lower()
+    if activo not in VALORES_FILTRO_ACTIVO:
+        raise HTTPException(status_code=400, detail="activo debe ser true, false o todos")
+    try:
+        query = f"SELECT {columnas_sql(campos)} FROM Productos WHERE 1=1"
         params = []
         
-        if activo is not None:
-            query += " AND activo = ?"
-            params.append(activo)
+        # Literal en lugar de parámetro para que se use el índice filtrado
+        if VALORES_FILTRO_ACTIVO[activo] is not None:
+            query += f" AND activo = {VALORES_FILTRO_ACTIVO[activo]}"
             
         if categoria:
             query += " AND categoria = ?"
@@ -644,12 +1604,10 @@ async def listar_productos(activo: bool = None, categoria: str = None):
             
         query += " ORDER BY nombre"
         
-        cursor.execute(query, params)
-        
-        columns = [column[0] for column in cursor.description]
+        columns, rows, _ = ejecutar_lectura(request, query, params)
         productos = []
         
-        for row in cursor.fetchall():
+        for row in rows:
             # Convertir la fecha de vencimiento a string ISO si existe
             row_dict = dict(zip(columns, row))
             if 'fecha_vencimiento' in row_dict and row_dict['fecha_vencimiento']:
@@ -658,42 +1616,95 @@ async def listar_productos(activo: bool = None, categoria: str = None):
                 row_dict['fecha_creacion'] = row_dict['fecha_creacion'].isoformat()
             productos.append(row_dict)
         
+        if campos:
+            # Respuesta parcial: no se valida contra el modelo completo
+            return JSONResponse(content=jsonable_encoder(productos))
         return productos
         
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/productos/lote", response_model=List[Producto])
+def obtener_productos_lote(request: Request, ids: str, fields: str = None):
+    """Obtener varios productos por id en una sola consulta (?ids=1,2,3)"""
+    campos = parsear_campos(fields)
+    try:
+        ids_pedidos = list(dict.fromkeys(int(i) for i in ids.split(',') if i.strip()))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="ids debe ser una lista de enteros separados por comas")
+    if not ids_pedidos:
+        raise HTTPException(status_code=400, detail="No se proporcionaron ids")
+    if len(ids_pedidos) > LOTE_MAX_IDS:
+        raise HTTPException(status_code=400, detail=f"Máximo {LOTE_MAX_IDS} ids por consulta")
+
+    # Tras una escritura propia (read-your-writes) no se usa la caché
+    usar_cache = not requiere_primario(request)
+    try:
+        encontrados = {}
+        if usar_cache:
+            for producto_id in ids_pedidos:
+                producto = cache_obtener(producto_id)
+                if producto is not None:
+                    encontrados[producto_id] = producto
+
+        faltantes = [i for i in ids_pedidos if i not in encontrados]
+        if faltantes:
+            version = version_cache() if usar_cache else None
+            columns, rows, desde_primario = ejecutar_lectura(
+                request,
+                f"SELECT {columnas_sql(campos)} FROM Productos "
+                f"WHERE id IN ({', '.join('?' for _ in faltantes)})",
+                faltantes
+            )
+            guardar = usar_cache and not campos and desde_primario
+            for row in rows:
+                producto = fila_a_producto(columns, row)
+                if guardar:
+                    cache_guardar(producto, version)
+                encontrados[producto['id']] = producto
+
+        # Mismo orden que ?ids=; los ids inexistentes se omiten
+        productos = [proyectar(encontrados[i], campos) for i in ids_pedidos if i in encontrados]
+        if campos:
+            return JSONResponse(content=jsonable_encoder(productos))
+        return productos
+
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
 
 @app.get("/api/productos/{producto_id}", response_model=Producto)
-async def obtener_producto(producto_id: int):
+def obtener_producto(producto_id: int, request: Request, fields: str = None):
     """Obtener un producto por su ID"""
-    conn = None
-    cursor = None
+    campos = parsear_campos(fields)
+    # Tras una escritura propia (read-your-writes) no se usa la caché
+    usar_cache = not requiere_primario(request)
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        producto = cache_obtener(producto_id) if usar_cache else None
+        if producto is not None:
+            if campos:
+                return JSONResponse(content=jsonable_encoder(proyectar(producto, campos)))
+            return producto
         
-        cursor.execute(
-            "SELECT * FROM Productos WHERE id = ?",
+        version = version_cache() if usar_cache else None
+        columns, rows, desde_primario = ejecutar_lectura(
+            request,
+            f"SELECT {columnas_sql(campos)} FROM Productos WHERE id = ?",
             (producto_id,)
         )
         
-        row = cursor.fetchone()
-        if not row:
+        if not rows:
             raise HTTPException(status_code=404, detail="Producto no encontrado")
         
-        columns = [column[0] for column in cursor.description]
-        producto = dict(zip(columns, row))
-        
-        # Convertir fechas a string ISO
-        if 'fecha_vencimiento' in producto and producto['fecha_vencimiento']:
-            producto['fecha_vencimiento'] = producto['fecha_vencimiento'].isoformat()
-        if 'fecha_creacion' in producto and producto['fecha_creacion']:
-            producto['fecha_creacion'] = producto['fecha_creacion'].isoformat()
+        producto = fila_a_producto(columns, rows[0])
+        if campos:
+            return JSONResponse(content=jsonable_encoder(producto))
+        # Una fila de la réplica puede ser anterior a la última versión: no se cachea
+        if usar_cache and desde_primario:
+            cache_guardar(producto, version)
         
         return producto
         
@@ -701,25 +1712,22 @@ async def obtener_producto(producto_id: int):
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
 
 @app.put("/api/productos/{producto_id}", response_model=Producto)
-async def actualizar_producto(producto_id: int, producto: ProductoUpdate):
+def actualizar_producto(producto_id: int, producto: ProductoUpdate, response: Response):
     """Actualizar un producto existente"""
     conn = None
     cursor = None
     try:
-        # Verificar si el producto existe
+        # Verificar si el producto existe (y bloquearlo para el resumen)
         conn = get_db_connection()
         cursor = conn.cursor()
         
-        cursor.execute("SELECT id FROM Productos WHERE id = ?", (producto_id,))
-        if not cursor.fetchone():
+        cursor.execute("SELECT * FROM Productos WITH (UPDLOCK) WHERE id = ?", (producto_id,))
+        row = cursor.fetchone()
+        if not row:
             raise HTTPException(status_code=404, detail="Producto no encontrado")
+        producto_anterior = dict(zip([column[0] for column in cursor.description], row))
         
         # Construir la consulta dinámicamente basada en los campos proporcionados
         update_fields = []
@@ -768,6 +1776,7 @@ async def actualizar_producto(producto_id: int, producto: ProductoUpdate):
         if producto.activo is not None:
             update_fields.append("activo = ?")
             params.append(producto.activo)
+            update_fields.append("fecha_baja = NULL" if producto.activo else "fecha_baja = ISNULL(fecha_baja, GETDATE())")
         
         if not update_fields:
             raise HTTPException(status_code=400, detail="No se proporcionaron datos para actualizar")
@@ -779,14 +1788,22 @@ async def actualizar_producto(producto_id: int, producto: ProductoUpdate):
         query = f"UPDATE Productos SET {', '.join(update_fields)} WHERE id = ?"
         cursor.execute(query, params)
         
-        conn.commit()
-        
-        # Obtener el producto actualizado para devolverlo
+        # Obtener el producto actualizado para el resumen y la respuesta
         cursor.execute("SELECT * FROM Productos WHERE id = ?", (producto_id,))
         
         columns = [column[0] for column in cursor.description]
         producto_actualizado = dict(zip(columns, cursor.fetchone()))
         
+        deltas = {}
+        acumular_resumen(deltas, producto_anterior, -1)
+        acumular_resumen(deltas, producto_actualizado, 1)
+        aplicar_resumen(cursor, deltas)
+        incrementar_version_catalogo(cursor)
+        
+        conn.commit()
+        cache_invalidar(producto_id)
+        marcar_escritura(response)
+        
         # Convertir fechas a string ISO
         if 'fecha_vencimiento' in producto_actualizado and producto_actualizado['fecha_vencimiento']:
             producto_actualizado['fecha_vencimiento'] = producto_actualizado['fecha_vencimiento'].isoformat()
@@ -813,8 +1830,8 @@ async def actualizar_producto(producto_id: int, producto: ProductoUpdate):
             conn.close()
 
 @app.delete("/api/productos/{producto_id}")
-async def eliminar_producto(producto_id: int):
-    """Eliminar un producto del inventario"""
+def eliminar_producto(producto_id: int, response: Response):
+    """Dar de baja un producto (eliminación lógica)"""
     conn = None
     cursor = None
     try:
@@ -822,13 +1839,24 @@ async def eliminar_producto(producto_id: int):
         cursor = conn.cursor()
         
         # Verificar si el producto existe
-        cursor.execute("SELECT id FROM Productos WHERE id = ?", (producto_id,))
-        if not cursor.fetchone():
+        cursor.execute("SELECT * FROM Productos WITH (UPDLOCK) WHERE id = ?", (producto_id,))
+        row = cursor.fetchone()
+        if not row:
             raise HTTPException(status_code=404, detail="Producto no encontrado")
+        producto_anterior = dict(zip([column[0] for column in cursor.description], row))
         
-        # Eliminar el producto
-        cursor.execute("DELETE FROM Productos WHERE id = ?", (producto_id,))
+        # Baja lógica: el producto queda inactivo hasta que se archive
+        cursor.execute(
+            "UPDATE Productos SET activo = 0, fecha_baja = ISNULL(fecha_baja, GETDATE()) WHERE id = ?",
+            (producto_id,)
+        )
+        deltas = {}
+        acumular_resumen(deltas, producto_anterior, -1)
+        aplicar_resumen(cursor, deltas)
+        incrementar_version_catalogo(cursor)
         conn.commit()
+        cache_invalidar(producto_id)
+        marcar_escritura(response)
         
         return {"mensaje": "Producto eliminado correctamente"}
         
@@ -842,7 +1870,68 @@ async def eliminar_producto(producto_id: int):
         if conn:
             conn.close()
 
+@app.post("/api/productos/archivar")
+def archivar_productos():
+    """Archivar ya los productos dados de baja hace más de ARCHIVE_AFTER_DAYS días"""
+    try:
+        return {"archivados": archivar_inactivos()}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# ==================== VALORACIÓN DE INVENTARIO ====================
+
+@app.get("/api/inventario/valoracion/{dimension}", response_model=List[ValoracionGrupo])
+def valoracion_inventario(dimension: str, request: Request):
+    """Valor del stock activo y margen por categoría o proveedor"""
+    if dimension not in DIMENSIONES_RESUMEN:
+        raise HTTPException(status_code=400, detail="La dimensión debe ser 'categoria' o 'proveedor'")
+    try:
+        _, rows, _ = ejecutar_lectura(
+            request,
+            """
+            SELECT valor, productos, unidades, valor_compra, valor_venta
+            FROM ResumenInventario
+            WHERE dimension = ?
+            ORDER BY valor_venta DESC
+            """,
+            (dimension,)
+        )
+        
+        grupos = []
+        for valor, productos, unidades, valor_compra, valor_venta in rows:
+            margen = valor_venta - valor_compra
+            grupos.append({
+                "grupo": valor or None,
+                "productos": productos,
+                "unidades": unidades,
+                "valor_compra": valor_compra,
+                "valor_venta": valor_venta,
+                "margen": margen,
+                "margen_porcentaje": round(margen / valor_venta * 100, 2) if valor_venta else None
+            })
+        
+        return grupos
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/inventario/valoracion/reconciliar")
+def reconciliar_valoracion():
+    """Recalcular por completo el resumen de valoración desde Productos"""
+    try:
+        if not reconciliar_resumen():
+            raise HTTPException(status_code=409, detail="Ya hay una conciliación en curso")
+        return {"mensaje": "Resumen de valoración recalculado"}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 # Ejecutar la aplicación si se ejecuta directamente
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run("app:app", host="0.0.0.0", port=8000, workers=int(os.getenv('API_WORKERS', '1')))
@@ -1,10 +1,18 @@
-CREATE DATABASE InventarioComidaDB;
+-- Script idempotente: db-init lo ejecuta en cada arranque sobre el volumen
+-- persistente, así que crea lo que falte y actualiza las bases existentes
+IF DB_ID('InventarioComidaDB') IS NULL
+    CREATE DATABASE InventarioComidaDB;
 GO
 
 USE InventarioComidaDB;
 GO
 
+-- Requerido para los índices filtrados (sqlcmd lo desactiva por defecto)
+SET QUOTED_IDENTIFIER ON;
+GO
+
 -- Tabla de Productos (versión simplificada)
+IF OBJECT_ID('Productos', 'U') IS NULL
 CREATE TABLE Productos (
     id INT IDENTITY(1,1) PRIMARY KEY,
     codigo_barras NVARCHAR(50) UNIQUE,
@@ -18,15 +26,101 @@ CREATE TABLE Productos (
     stock_minimo INT DEFAULT 10,
     fecha_vencimiento DATE,
     fecha_creacion DATETIME DEFAULT GETDATE(),
-    activo BIT DEFAULT 1
+    activo BIT DEFAULT 1,
+    fecha_baja DATETIME NULL
 );
+GO
+
+-- Bases creadas antes de la baja lógica: añadir fecha_baja
+IF COL_LENGTH('Productos', 'fecha_baja') IS NULL
+    ALTER TABLE Productos ADD fecha_baja DATETIME NULL;
+GO
+
+-- Productos ya inactivos sin fecha de baja: el plazo de archivo empieza ahora
+UPDATE Productos SET fecha_baja = GETDATE()
+WHERE activo = 0 AND fecha_baja IS NULL;
+GO
 
--- Insertar algunos productos de ejemplo
+-- Listado por defecto: solo productos activos, ordenados por nombre
+IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'IX_Productos_activos_nombre' AND object_id = OBJECT_ID('Productos'))
+CREATE INDEX IX_Productos_activos_nombre ON Productos (nombre)
+    INCLUDE (codigo_barras, descripcion, categoria, proveedor, precio_compra, precio_venta,
+             stock_actual, stock_minimo, fecha_vencimiento, fecha_creacion, activo, fecha_baja)
+    WHERE activo = 1;
+
+-- Búsqueda de productos inactivos para el archivo
+IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'IX_Productos_inactivos_baja' AND object_id = OBJECT_ID('Productos'))
+CREATE INDEX IX_Productos_inactivos_baja ON Productos (fecha_baja)
+    WHERE activo = 0;
+
+-- Productos dados de baja hace tiempo, fuera de la tabla principal
+IF OBJECT_ID('ProductosArchivo', 'U') IS NULL
+CREATE TABLE ProductosArchivo (
+    id INT PRIMARY KEY,
+    codigo_barras NVARCHAR(50),
+    nombre NVARCHAR(100) NOT NULL,
+    descripcion NVARCHAR(255),
+    categoria NVARCHAR(50),
+    proveedor NVARCHAR(100),
+    precio_compra DECIMAL(10, 2) NOT NULL,
+    precio_venta DECIMAL(10, 2) NOT NULL,
+    stock_actual INT NOT NULL,
+    stock_minimo INT,
+    fecha_vencimiento DATE,
+    fecha_creacion DATETIME,
+    fecha_baja DATETIME,
+    fecha_archivo DATETIME NOT NULL DEFAULT GETDATE()
+);
+
+-- Versión del catálogo: se incrementa en cada escritura para que cada
+-- worker de la API invalide su caché en proceso
+IF OBJECT_ID('VersionCatalogo', 'U') IS NULL
+CREATE TABLE VersionCatalogo (
+    id INT PRIMARY KEY CHECK (id = 1),
+    version BIGINT NOT NULL DEFAULT 0
+);
+GO
+
+IF NOT EXISTS (SELECT 1 FROM VersionCatalogo WHERE id = 1)
+    INSERT INTO VersionCatalogo (id, version) VALUES (1, 0);
+
+-- Valoración del inventario activo por categoría y proveedor. La API la
+-- mantiene de forma incremental en cada escritura y la concilia periódicamente
+IF OBJECT_ID('ResumenInventario', 'U') IS NULL
+CREATE TABLE ResumenInventario (
+    dimension NVARCHAR(20) NOT NULL,   -- 'categoria' o 'proveedor'
+    valor NVARCHAR(100) NOT NULL,      -- '' cuando el producto no tiene valor
+    productos INT NOT NULL,
+    unidades BIGINT NOT NULL,
+    valor_compra DECIMAL(18, 2) NOT NULL,
+    valor_venta DECIMAL(18, 2) NOT NULL,
+    CONSTRAINT PK_ResumenInventario PRIMARY KEY (dimension, valor)
+);
+GO
+
+-- Insertar algunos productos de ejemplo (solo en una base nueva)
+IF NOT EXISTS (SELECT 1 FROM Productos)
 INSERT INTO Productos (codigo_barras, nombre, descripcion, categoria, proveedor, precio_compra, precio_venta, stock_actual, stock_minimo, fecha_vencimiento)
-VALUES 
+VALUES
 ('7501001234567', 'Leche Entera 1L', 'Leche entera pasteurizada', 'Lácteos', 'Lácteos La Vaquita', 15.50, 25.00, 50, 10, '2023-12-31'),
 ('7501012345678', 'Huevo Blanco 1kg', 'Huevo blanco grado AA', 'Huevos', 'Avícola San Juan', 45.00, 65.00, 30, 5, '2023-11-15'),
 ('7501023456789', 'Arroz 1kg', 'Arroz blanco grano largo', 'Granos', 'Distribuidora de Granos', 25.00, 35.00, 100, 20, '2024-06-30'),
 ('7501034567890', 'Frijol Negro 1kg', 'Frijol negro mayocoba', 'Legumbres', 'Distribuidora de Granos', 30.00, 45.00, 75, 15, '2024-05-31'),
 ('7501045678901', 'Manzana Roja', 'Manzana roja deliciosa', 'Frutas', 'Frutas y Verduras Frescas', 25.00, 40.00, 60, 10, '2023-11-30');
 GO
+
+-- Resumen inicial a partir de los productos existentes (solo si está vacío)
+IF NOT EXISTS (SELECT 1 FROM ResumenInventario)
+INSERT INTO ResumenInventario (dimension, valor, productos, unidades, valor_compra, valor_venta)
+SELECT 'categoria', ISNULL(categoria, ''), COUNT(*), SUM(CAST(stock_actual AS BIGINT)),
+       SUM(stock_actual * precio_compra), SUM(stock_actual * precio_venta)
+FROM Productos
+WHERE activo = 1
+GROUP BY ISNULL(categoria, '')
+UNION ALL
+SELECT 'proveedor', ISNULL(proveedor, ''), COUNT(*), SUM(CAST(stock_actual AS BIGINT)),
+       SUM(stock_actual * precio_compra), SUM(stock_actual * precio_venta)
+FROM Productos
+WHERE activo = 1
+GROUP BY ISNULL(proveedor, '');
+GO